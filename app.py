@@ -1,248 +1,460 @@
-from flask import Flask, render_template, request, send_from_directory
+from flask import Flask, Response, abort, jsonify, render_template, request, send_from_directory
+from werkzeug.exceptions import HTTPException
+from werkzeug.security import safe_join
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import lru_cache, partial
 from PIL import Image, ImageDraw
+import numpy as np
+import hashlib
+import json
+import math
+import mimetypes
 import os
 import re
-import colorsys
-import random
+import threading
+import time
 
 app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+X_ACCEL_REDIRECT_PREFIX = os.environ.get('X_ACCEL_REDIRECT_PREFIX', '').rstrip('/')
 IMAGE_FOLDER = 'static/generated_images'
+IMAGE_PATH_PREFIX = os.path.join(IMAGE_FOLDER, '')
+IMAGE_URL_PREFIX = f'/{IMAGE_FOLDER}/'
 PROMPTS_FILE = 'prompts.txt'
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+# Part of every image filename. Bump it whenever a drawing change alters
+# the output for existing prompts, so cached images get new URLs.
+RENDER_VERSION = 1
+# Seconds a failed render is remembered for its /progress stream.
+JOB_TTL = 60
+# How long /progress waits for an image, and how often it checks.
+PROGRESS_TIMEOUT = 30
+PROGRESS_POLL_INTERVAL = 0.1
+# File extension and encoder settings per output format, tuned for
+# encoding speed: PNG at the fastest zlib level, WebP at its fastest method.
+IMAGE_FORMATS = {
+    'JPEG': ('.jpg', {'quality': 85, 'optimize': False}),
+    'PNG': ('.png', {'compress_level': 1}),
+    'WEBP': ('.webp', {'quality': 85, 'method': 0}),
+}
+IMAGE_FORMAT = os.environ.get('IMAGE_FORMAT', 'JPEG').strip().upper()
+if IMAGE_FORMAT == 'JPG':
+    IMAGE_FORMAT = 'JPEG'
+if IMAGE_FORMAT not in IMAGE_FORMATS:
+    raise ValueError(f"Unsupported IMAGE_FORMAT {IMAGE_FORMAT!r}; "
+                     f"use one of {', '.join(IMAGE_FORMATS)}")
+IMAGE_EXTENSION, IMAGE_SAVE_OPTIONS = IMAGE_FORMATS[IMAGE_FORMAT]
+MAX_PROMPT_LENGTH = 200
+PROMPT_TOO_LONG = f"Please keep the prompt to {MAX_PROMPT_LENGTH} characters or fewer"
 os.makedirs(IMAGE_FOLDER, exist_ok=True)
 
 WIDTH, HEIGHT = 800, 600
 
-def create_gradient(draw, y_start, y_end, color1, color2):
-    for y in range(y_start, y_end):
-        ratio = (y - y_start) / (y_end - y_start)
-        r1, g1, b1 = color1
-        r2, g2, b2 = color2
-        r = int(r1 + (r2 - r1) * ratio)
-        g = int(g1 + (g2 - g1) * ratio)
-        b = int(b1 + (b2 - b1) * ratio)
-        draw.line([(0, y), (WIDTH, y)], fill=(r, g, b))
+BROWN = (139, 69, 19)
+DARK_BROWN = (101, 67, 33)
+MOUNTAIN_COLORS = [DARK_BROWN, BROWN, (160, 82, 45)]
+FOLIAGE_COLORS = [(34, 139, 34), (0, 100, 0), (0, 128, 0)]
 
-def generate_image(prompt):
+PETAL_DIRECTIONS = [(math.cos(math.radians(angle)), math.sin(math.radians(angle)))
+                    for angle in range(0, 360, 60)]
+SUN_RAY_DIRECTIONS = [(math.cos(math.radians(angle)), math.sin(math.radians(angle)))
+                      for angle in range(0, 360, 30)]
+# Five points, the first one straight up.
+STAR_DIRECTIONS = [(math.cos(math.radians(angle - 90)), math.sin(math.radians(angle - 90)))
+                   for angle in range(0, 360, 72)]
+
+# Per process: gunicorn already runs one worker per core, so each worker
+# only needs a couple of render threads.
+RENDER_THREADS = int(os.environ.get('RENDER_THREADS', 2))
+RENDER_POOL = ThreadPoolExecutor(max_workers=RENDER_THREADS)
+_inflight = {}
+_inflight_lock = threading.Lock()
+_failed_renders = {}  # job_id -> failed at, oldest first
+_failed_renders_lock = threading.Lock()
+
+def create_gradient(img, y_start, y_end, color1, color2, x_start=0, x_end=WIDTH):
+    height = y_end - y_start
+    # Integer arithmetic: floor division is exact, where the float ratio
+    # could land just under a whole number and truncate one step short.
+    steps = np.arange(height, dtype=np.int32)[:, None]
+    start = np.array(color1, dtype=np.int32)
+    delta = np.array(color2, dtype=np.int32) - start
+    rows = (start + delta * steps // height).astype(np.uint8)
+    band = np.broadcast_to(rows[:, None, :], (height, x_end - x_start, 3))
+    img.paste(Image.fromarray(np.ascontiguousarray(band)), (x_start, y_start))
+
+# Every render starts from one of two fixed backdrops, so build both
+# once and copy the right one per request.
+SKY_BASE = Image.new('RGB', (WIDTH, HEIGHT), 'white')
+create_gradient(SKY_BASE, 0, HEIGHT//2, (135, 206, 235), (65, 105, 225))
+GROUND_BASE = SKY_BASE.copy()
+create_gradient(GROUND_BASE, HEIGHT//2, HEIGHT, (34, 139, 34), (85, 107, 47))
+TRUNK = Image.new('RGB', (21, 100))
+create_gradient(TRUNK, 0, 100, BROWN, DARK_BROWN, 0, 21)
+
+def find_keywords(prompt):
+    return frozenset(match.group(1) for match in KEYWORD_RE.finditer(prompt))
+
+def save_image(img, filepath):
+    # Write under a temporary name first: the existence check in
+    # submit_image would otherwise keep serving a half-written file.
+    tmp_path = f'{filepath}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        img.save(tmp_path, IMAGE_FORMAT, **IMAGE_SAVE_OPTIONS)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def bake_sprite(draw_shapes, images=()):
+    # Shapes that never move are drawn once onto a transparent layer and
+    # pasted from then on, instead of being rasterised on every render.
+    # Any (image, position) pairs in images are pasted under the shapes.
+    layer = Image.new('RGBA', (WIDTH, HEIGHT))
+    for image, position in images:
+        layer.paste(image, position)
+    draw_shapes(ImageDraw.Draw(layer))
+    box = layer.getbbox()
+    layer = layer.crop(box)
+    # The shapes are not antialiased, so a 1-bit mask keeps them exact
+    # and pastes much faster than blending through the alpha channel.
+    return layer.convert('RGB'), layer.getchannel('A').convert('1'), box[:2]
+
+def paste_sprite(img, sprite, dx=0, dy=0):
+    image, mask, (x, y) = sprite
+    img.paste(image, (x + dx, y + dy), mask)
+
+def static_element(draw_shapes):
+    # For elements that look the same in every image: bake the shapes
+    # into a sprite at import and paste it when the element is drawn.
+    sprite = bake_sprite(draw_shapes)
+
+    def draw_element(img, draw, rng):
+        paste_sprite(img, sprite)
+
+    return draw_element
+
+@static_element
+def draw_mountain(draw):
+    for i, color in enumerate(MOUNTAIN_COLORS):
+        points = [
+            (0, HEIGHT - 100 + i*50),
+            (WIDTH//4, HEIGHT//2 - i*30),
+            (WIDTH//2, HEIGHT - 150 + i*40),
+            (3*WIDTH//4, HEIGHT//3 - i*20),
+            (WIDTH, HEIGHT - 200 + i*60),
+            (WIDTH, HEIGHT),
+            (0, HEIGHT)
+        ]
+        draw.polygon(points, fill=color)
+
+@static_element
+def draw_sun(draw):
+    for radius in range(60, 30, -5):
+        draw.ellipse((650-radius, 50-radius, 750+radius, 150+radius), 
+                   fill=(255, 255, min(255, 200 + radius)))
+    draw.ellipse((650, 50, 750, 150), fill='yellow')
+    for dx, dy in SUN_RAY_DIRECTIONS:
+        draw.line((700 + 50*dx, 100 + 50*dy, 700 + 110*dx, 100 + 110*dy), fill='yellow', width=4)
+
+def _draw_cloud_puff(draw):
+    x = 100
+    for offset in [(0,0), (20,-10), (40,0), (20,10)]:
+        draw.ellipse((x+offset[0], 80+offset[1], x+offset[0]+40, 120+offset[1]), 
+                   fill='white')
+
+# Clouds and trees repeat one shape along the x axis, so a single copy is
+# baked at the first position and pasted shifted for the others.
+CLOUD_PUFF = bake_sprite(_draw_cloud_puff)
+
+def draw_cloud(img, draw, rng):
+    for dx in [0, 200, 400]:
+        paste_sprite(img, CLOUD_PUFF, dx)
+
+def _draw_foliage(draw):
+    x = 100
+    for i, color in enumerate(FOLIAGE_COLORS):
+        points = [
+            (x - 30 + i*10, 400 - i*20),
+            (x + 10, 300 - i*30),
+            (x + 50 - i*10, 400 - i*20)
+        ]
+        draw.polygon(points, fill=color)
+
+TREE = bake_sprite(_draw_foliage, [(TRUNK, (100, 400))])
+
+def draw_tree(img, draw, rng):
+    for dx in range(0, 600, 200):
+        paste_sprite(img, TREE, dx)
+
+@static_element
+def draw_river(draw):
+    river_points = [(300, HEIGHT), (350, HEIGHT-100), (400, HEIGHT-150),
+                  (450, HEIGHT-200), (500, HEIGHT-250), (550, HEIGHT-200),
+                  (600, HEIGHT-150), (650, HEIGHT-100), (700, HEIGHT)]
+    draw.line(river_points, fill=(0, 0, 240), width=40, joint='curve')
+    draw.line(river_points, fill=(0, 0, 220), width=20, joint='curve')
+
+@static_element
+def draw_cow(draw):
+    x, y = 200, 450
+    draw.ellipse((x, y, x+80, y+50), fill='white')
+    draw.ellipse((x+70, y-10, x+100, y+20), fill='white')
+    for leg_x in [x+20, x+60]:
+        draw.rectangle((leg_x, y+50, leg_x+10, y+80), fill='black')
+    for spot_x, spot_y in [(x+20, y+10), (x+50, y+20), (x+30, y+30)]:
+        draw.ellipse((spot_x, spot_y, spot_x+20, spot_y+15), fill='black')
+    draw.ellipse((x+85, y, x+90, y+5), fill='black')
+    draw.polygon([(x+75, y-10), (x+85, y-20), (x+95, y-10)], fill='pink')
+
+def draw_table(img, draw, rng):
+    x, y = 400, 400
+    draw.rectangle((x, y, x+120, y+10), fill='brown')
+    for leg_x in [x+20, x+100]:
+        draw.rectangle((leg_x, y+10, leg_x+10, y+60), fill='brown')
+
+@static_element
+def draw_computer(draw):
+    x, y = 420, 380
+    draw.rectangle((x, y, x+80, y+60), fill='gray')
+    draw.rectangle((x+5, y+5, x+75, y+55), fill='black')
+    draw.rectangle((x+35, y+60, x+45, y+80), fill='gray')
+    draw.ellipse((x+20, y+80, x+60, y+90), fill='gray')
+
+@static_element
+def draw_book(draw):
+    x, y = 300, 450
+    draw.rectangle((x, y, x+60, y+80), fill='red')
+    draw.rectangle((x+5, y+5, x+55, y+75), fill='white')
+    for i in range(5):
+        draw.line((x+10, y+15+i*12, x+50, y+15+i*12), fill='black', width=1)
+
+def draw_man(img, draw, rng):
+    x, y = 500, 400
+    draw.ellipse((x, y, x+30, y+30), fill='peachpuff')
+    draw.rectangle((x+10, y+30, x+20, y+80), fill='blue')
+    draw.line((x+10, y+40, x-10, y+60), fill='blue', width=5)
+    draw.line((x+20, y+40, x+40, y+60), fill='blue', width=5)
+    draw.line((x+10, y+80, x+5, y+100), fill='black', width=5)
+    draw.line((x+20, y+80, x+25, y+100), fill='black', width=5)
+
+def draw_woman(img, draw, rng):
+    x, y = 600, 400
+    draw.ellipse((x, y, x+30, y+30), fill='peachpuff')
+    draw.polygon([(x+5, y+30), (x+25, y+30), (x+30, y+80), (x, y+80)], fill='pink')
+    draw.line((x+5, y+40, x-10, y+60), fill='pink', width=5)
+    draw.line((x+25, y+40, x+40, y+60), fill='pink', width=5)
+    draw.line((x+10, y+80, x+8, y+100), fill='black', width=5)
+    draw.line((x+20, y+80, x+22, y+100), fill='black', width=5)
+    draw.arc((x-5, y, x+35, y+20), 180, 0, fill='brown', width=5)
+
+@static_element
+def draw_house(draw):
+    x, y = 100, 300
+    draw.rectangle((x, y, x+120, y+100), fill='beige')
+    draw.polygon([(x-10, y), (x+60, y-50), (x+130, y)], fill='brown')
+    draw.rectangle((x+40, y+50, x+80, y+100), fill='brown')
+    draw.rectangle((x+15, y+30, x+35, y+50), fill='lightblue')
+    draw.rectangle((x+85, y+30, x+105, y+50), fill='lightblue')
+
+def draw_flower(img, draw, rng):
+    for x in range(100, 700, 100):
+        draw.line((x, 450, x, 500), fill='green', width=3)
+        for dx, dy in PETAL_DIRECTIONS:
+            petal_x = x + 15 * dx
+            petal_y = 450 + 15 * dy
+            draw.ellipse((petal_x-5, petal_y-5, petal_x+5, petal_y+5), fill='yellow')
+        draw.ellipse((x-5, 445, x+5, 455), fill='orange')
+
+def draw_bird(img, draw, rng):
+    for x in range(100, 700, 150):
+        draw.arc((x, 100, x+30, 120), 0, 180, fill='black', width=2)
+        draw.arc((x+10, 95, x+25, 110), 0, 180, fill='black', width=2)
+        draw.arc((x+15, 95, x+30, 110), 0, 180, fill='black', width=2)
+
+def _star_drawer(size):
+    def draw_shapes(draw):
+        x = y = STAR_ORIGIN
+        for dx, dy in STAR_DIRECTIONS:
+            draw.line((x, y, x + size * 3 * dx, y + size * 3 * dy), fill='yellow', width=1)
+        draw.ellipse((x-size, y-size, x+size, y+size), fill='yellow')
+    return draw_shapes
+
+# Stars only come in three sizes, so each is baked once around
+# STAR_ORIGIN and pasted shifted to wherever the star lands.
+STAR_ORIGIN = 50
+STAR_SIZES = range(2, 5)
+STARS = {size: bake_sprite(_star_drawer(size)) for size in STAR_SIZES}
+
+def draw_star(img, draw, rng):
+    xs = rng.integers(50, WIDTH-50, size=20, endpoint=True).tolist()
+    ys = rng.integers(50, HEIGHT//3, size=20, endpoint=True).tolist()
+    sizes = rng.integers(STAR_SIZES.start, STAR_SIZES.stop, size=20).tolist()
+    for x, y, size in zip(xs, ys, sizes):
+        paste_sprite(img, STARS[size], x - STAR_ORIGIN, y - STAR_ORIGIN)
+
+def draw_moon(img, draw, rng):
+    x, y = 100, 100
+    draw.ellipse((x, y, x+60, y+60), fill='lightyellow')
+    for crater_x, crater_y in [(x+20, y+20), (x+40, y+30), (x+30, y+45)]:
+        draw.ellipse((crater_x, crater_y, crater_x+10, crater_y+10), fill='gray')
+
+def draw_grass(img, draw, rng):
+    xs = range(0, WIDTH, 5)
+    tops = (HEIGHT - rng.integers(10, 30, size=len(xs), endpoint=True)).tolist()
+    blade_dxs = rng.integers(-30, 30, size=(len(xs), 3), endpoint=True).tolist()
+    blade_dys = rng.integers(-5, 5, size=(len(xs), 3), endpoint=True).tolist()
+    for x, top, dxs, dys in zip(xs, tops, blade_dxs, blade_dys):
+        draw.line((x, HEIGHT, x, top), fill='green', width=2)
+        for dx, dy in zip(dxs, dys):
+            draw.line((x, top, x + dx, top + dy), fill='lightgreen', width=1)
+
+def draw_butterfly(img, draw, rng):
+    xs = range(200, 600, 150)
+    ys = rng.integers(150, 250, size=len(xs), endpoint=True).tolist()
+    for x, y in zip(xs, ys):
+        for wing_x, wing_y in [(x-20, y-20), (x+20, y-20)]:
+            draw.ellipse((wing_x, wing_y, wing_x+40, wing_y+30), fill='purple')
+            draw.ellipse((wing_x+5, wing_y+5, wing_x+35, wing_y+25), fill='pink')
+        draw.line((x, y, x, y+30), fill='black', width=2)
+        draw.line((x, y, x-10, y-10), fill='black', width=1)
+        draw.line((x, y, x+10, y-10), fill='black', width=1)
+
+def draw_fence(img, draw, rng):
+    for x in range(0, WIDTH, 30):
+        draw.rectangle((x, HEIGHT-100, x+5, HEIGHT-50), fill='brown')
+    # The rails of neighbouring sections meet, so fill each in one go.
+    for rail_y in [HEIGHT-90, HEIGHT-70, HEIGHT-50]:
+        draw.rectangle((0, rail_y, WIDTH, rail_y+5), fill='brown')
+
+@static_element
+def draw_path(draw):
+    path_points = [(100, HEIGHT), (200, HEIGHT-50), (300, HEIGHT-100),
+                  (400, HEIGHT-50), (500, HEIGHT-100), (600, HEIGHT-50),
+                  (700, HEIGHT)]
+    draw.line(path_points, fill='sandybrown', width=40, joint='curve')
+    for edge in [-20, 20]:
+        draw.line([(x, y + edge) for x, y in path_points], fill='saddlebrown', width=2)
+
+@static_element
+def draw_bench(draw):
+    x, y = 300, 450
+    draw.rectangle((x, y, x+120, y+10), fill='brown')
+    draw.rectangle((x, y-40, x+120, y-35), fill='brown')
+    for leg_x in [x+20, x+100]:
+        draw.rectangle((leg_x, y+10, leg_x+10, y+40), fill='brown')
+
+# Elements in painting order; later entries are drawn on top.
+ELEMENTS = [
+    (('mountain',), draw_mountain),
+    (('sun',), draw_sun),
+    (('cloud',), draw_cloud),
+    (('tree',), draw_tree),
+    (('river',), draw_river),
+    (('cow',), draw_cow),
+    (('table',), draw_table),
+    (('computer',), draw_computer),
+    (('book',), draw_book),
+    (('man', 'person'), draw_man),
+    (('woman',), draw_woman),
+    (('house',), draw_house),
+    (('flower',), draw_flower),
+    (('bird',), draw_bird),
+    (('star',), draw_star),
+    (('moon',), draw_moon),
+    (('grass',), draw_grass),
+    (('butterfly',), draw_butterfly),
+    (('fence',), draw_fence),
+    (('path',), draw_path),
+    (('bench',), draw_bench),
+]
+
+KEYWORDS = [keyword for keywords, _ in ELEMENTS for keyword in keywords]
+# A lookahead lets overlapping keywords match too, e.g. 'man' inside 'woman'.
+KEYWORD_RE = re.compile('(?=(%s))' % '|'.join(KEYWORDS))
+# Elements that stand on the ground get the grass backdrop.
+GROUND_KEYWORDS = frozenset(['cow', 'table', 'computer', 'book', 'man', 'woman', 'person',
+                             'grass', 'flower', 'bird'])
+UNSAFE_FILENAME_CHARS = re.compile(r'[^a-z0-9]')
+JOB_ID_RE = re.compile(r'[a-z0-9_]+')
+
+@lru_cache(maxsize=256)
+def plan_elements(hits):
+    # Most prompts share a handful of keyword combinations, so resolve
+    # each combination to its draw functions once.
+    return tuple(draw_element for keywords, draw_element in ELEMENTS
+                 if hits.intersection(keywords))
+
+def render_image(prompt, filepath):
     try:
-        img = Image.new('RGB', (WIDTH, HEIGHT), 'white')
-        draw = ImageDraw.Draw(img)
-        
-        create_gradient(draw, 0, HEIGHT//2, (135, 206, 235), (65, 105, 225))
-        
         prompt = prompt.lower()
+        hits = find_keywords(prompt)
+        # Seed from the prompt so a re-render matches the cached file.
+        rng = np.random.default_rng(int.from_bytes(prompt.encode(), 'big'))
         
-        if any(word in prompt for word in ['cow', 'table', 'computer', 'book', 'man', 'woman', 'person', 'grass', 'flower', 'bird']):
-            create_gradient(draw, HEIGHT//2, HEIGHT, (34, 139, 34), (85, 107, 47))
-        
-        if 'mountain' in prompt:
-            mountain_colors = [(101, 67, 33), (139, 69, 19), (160, 82, 45)]
-            for i, color in enumerate(mountain_colors):
-                points = [
-                    (0, HEIGHT - 100 + i*50),
-                    (WIDTH//4, HEIGHT//2 - i*30),
-                    (WIDTH//2, HEIGHT - 150 + i*40),
-                    (3*WIDTH//4, HEIGHT//3 - i*20),
-                    (WIDTH, HEIGHT - 200 + i*60),
-                    (WIDTH, HEIGHT),
-                    (0, HEIGHT)
-                ]
-                draw.polygon(points, fill=color)
-        
-        if 'sun' in prompt:
-            for radius in range(60, 30, -5):
-                draw.ellipse((650-radius, 50-radius, 750+radius, 150+radius), 
-                           fill=(255, 255, min(255, 200 + radius)))
-            draw.ellipse((650, 50, 750, 150), fill='yellow')
-            for i in range(12):
-                angle = i * 30
-                x = 700 + 80 * (1 if i < 6 else -1)
-                y = 100 + 80 * (1 if i < 6 else -1)
-                draw.line((700, 100, x, y), fill='yellow', width=4)
-        
-        if 'cloud' in prompt:
-            for x in [100, 300, 500]:
-                for offset in [(0,0), (20,-10), (40,0), (20,10)]:
-                    draw.ellipse((x+offset[0], 80+offset[1], x+offset[0]+40, 120+offset[1]), 
-                               fill='white')
-        
-        if 'tree' in prompt:
-            for x in range(100, 700, 200):
-                for y in range(400, 500):
-                    ratio = (y - 400) / 100
-                    brown = (139, 69, 19)
-                    dark_brown = (101, 67, 33)
-                    r = int(brown[0] + (dark_brown[0] - brown[0]) * ratio)
-                    g = int(brown[1] + (dark_brown[1] - brown[1]) * ratio)
-                    b = int(brown[2] + (dark_brown[2] - brown[2]) * ratio)
-                    draw.line([(x, y), (x + 20, y)], fill=(r, g, b))
-                
-                foliage_colors = [(34, 139, 34), (0, 100, 0), (0, 128, 0)]
-                for i, color in enumerate(foliage_colors):
-                    points = [
-                        (x - 30 + i*10, 400 - i*20),
-                        (x + 10, 300 - i*30),
-                        (x + 50 - i*10, 400 - i*20)
-                    ]
-                    draw.polygon(points, fill=color)
-        
-        if 'river' in prompt:
-            river_points = [(300, HEIGHT), (350, HEIGHT-100), (400, HEIGHT-150),
-                          (450, HEIGHT-200), (500, HEIGHT-250), (550, HEIGHT-200),
-                          (600, HEIGHT-150), (650, HEIGHT-100), (700, HEIGHT)]
-            for i in range(len(river_points)-1):
-                x1, y1 = river_points[i]
-                x2, y2 = river_points[i+1]
-                for width in range(40, 0, -5):
-                    draw.line([(x1, y1), (x2, y2)], 
-                             fill=(0, 0, min(255, 200 + width)), width=width)
-        
-        if 'cow' in prompt:
-            x, y = 200, 450
-            draw.ellipse((x, y, x+80, y+50), fill='white')
-            draw.ellipse((x+70, y-10, x+100, y+20), fill='white')
-            for leg_x in [x+20, x+60]:
-                draw.rectangle((leg_x, y+50, leg_x+10, y+80), fill='black')
-            for spot_x, spot_y in [(x+20, y+10), (x+50, y+20), (x+30, y+30)]:
-                draw.ellipse((spot_x, spot_y, spot_x+20, spot_y+15), fill='black')
-            draw.ellipse((x+85, y, x+90, y+5), fill='black')
-            draw.polygon([(x+75, y-10), (x+85, y-20), (x+95, y-10)], fill='pink')
-
-        if 'table' in prompt:
-            x, y = 400, 400
-            draw.rectangle((x, y, x+120, y+10), fill='brown')
-            for leg_x in [x+20, x+100]:
-                draw.rectangle((leg_x, y+10, leg_x+10, y+60), fill='brown')
-
-        if 'computer' in prompt:
-            x, y = 420, 380
-            draw.rectangle((x, y, x+80, y+60), fill='gray')
-            draw.rectangle((x+5, y+5, x+75, y+55), fill='black')
-            draw.rectangle((x+35, y+60, x+45, y+80), fill='gray')
-            draw.ellipse((x+20, y+80, x+60, y+90), fill='gray')
-
-        if 'book' in prompt:
-            x, y = 300, 450
-            draw.rectangle((x, y, x+60, y+80), fill='red')
-            draw.rectangle((x+5, y+5, x+55, y+75), fill='white')
-            for i in range(5):
-                draw.line((x+10, y+15+i*12, x+50, y+15+i*12), fill='black', width=1)
-
-        if 'man' in prompt or 'person' in prompt:
-            x, y = 500, 400
-            draw.ellipse((x, y, x+30, y+30), fill='peachpuff')
-            draw.rectangle((x+10, y+30, x+20, y+80), fill='blue')
-            draw.line((x+10, y+40, x-10, y+60), fill='blue', width=5)
-            draw.line((x+20, y+40, x+40, y+60), fill='blue', width=5)
-            draw.line((x+10, y+80, x+5, y+100), fill='black', width=5)
-            draw.line((x+20, y+80, x+25, y+100), fill='black', width=5)
-
-        if 'woman' in prompt:
-            x, y = 600, 400
-            draw.ellipse((x, y, x+30, y+30), fill='peachpuff')
-            draw.polygon([(x+5, y+30), (x+25, y+30), (x+30, y+80), (x, y+80)], fill='pink')
-            draw.line((x+5, y+40, x-10, y+60), fill='pink', width=5)
-            draw.line((x+25, y+40, x+40, y+60), fill='pink', width=5)
-            draw.line((x+10, y+80, x+8, y+100), fill='black', width=5)
-            draw.line((x+20, y+80, x+22, y+100), fill='black', width=5)
-            draw.arc((x-5, y, x+35, y+20), 180, 0, fill='brown', width=5)
-
-        if 'house' in prompt:
-            x, y = 100, 300
-            draw.rectangle((x, y, x+120, y+100), fill='beige')
-            draw.polygon([(x-10, y), (x+60, y-50), (x+130, y)], fill='brown')
-            draw.rectangle((x+40, y+50, x+80, y+100), fill='brown')
-            draw.rectangle((x+15, y+30, x+35, y+50), fill='lightblue')
-            draw.rectangle((x+85, y+30, x+105, y+50), fill='lightblue')
-
-        if 'flower' in prompt:
-            for x in range(100, 700, 100):
-                draw.line((x, 450, x, 500), fill='green', width=3)
-                for angle in range(0, 360, 60):
-                    rad = angle * 3.14159 / 180
-                    petal_x = x + 15 * (1 if angle < 180 else -1)
-                    petal_y = 450 + 15 * (1 if angle < 90 or angle > 270 else -1)
-                    draw.ellipse((petal_x-5, petal_y-5, petal_x+5, petal_y+5), fill='yellow')
-                draw.ellipse((x-5, 445, x+5, 455), fill='orange')
-
-        if 'bird' in prompt:
-            for x in range(100, 700, 150):
-                draw.arc((x, 100, x+30, 120), 0, 180, fill='black', width=2)
-                draw.arc((x+10, 95, x+25, 110), 0, 180, fill='black', width=2)
-                draw.arc((x+15, 95, x+30, 110), 0, 180, fill='black', width=2)
-
-        if 'star' in prompt or 'stars' in prompt:
-            for _ in range(20):
-                x = random.randint(50, WIDTH-50)
-                y = random.randint(50, HEIGHT//3)
-                size = random.randint(2, 4)
-                for angle in range(0, 360, 72):
-                    rad = angle * 3.14159 / 180
-                    end_x = x + size * 3 * (1 if angle < 180 else -1)
-                    end_y = y + size * 3 * (1 if angle < 90 or angle > 270 else -1)
-                    draw.line((x, y, end_x, end_y), fill='yellow', width=1)
-                draw.ellipse((x-size, y-size, x+size, y+size), fill='yellow')
-
-        if 'moon' in prompt:
-            x, y = 100, 100
-            draw.ellipse((x, y, x+60, y+60), fill='lightyellow')
-            for crater_x, crater_y in [(x+20, y+20), (x+40, y+30), (x+30, y+45)]:
-                draw.ellipse((crater_x, crater_y, crater_x+10, crater_y+10), fill='gray')
-
-        if 'grass' in prompt:
-            for x in range(0, WIDTH, 5):
-                height = random.randint(10, 30)
-                draw.line((x, HEIGHT, x, HEIGHT-height), fill='green', width=2)
-                for blade in range(3):
-                    angle = random.randint(-30, 30)
-                    end_x = x + angle
-                    end_y = HEIGHT - height + random.randint(-5, 5)
-                    draw.line((x, HEIGHT-height, end_x, end_y), fill='lightgreen', width=1)
-
-        if 'butterfly' in prompt:
-            for x in range(200, 600, 150):
-                y = random.randint(150, 250)
-                for wing_x, wing_y in [(x-20, y-20), (x+20, y-20)]:
-                    draw.ellipse((wing_x, wing_y, wing_x+40, wing_y+30), fill='purple')
-                    draw.ellipse((wing_x+5, wing_y+5, wing_x+35, wing_y+25), fill='pink')
-                draw.line((x, y, x, y+30), fill='black', width=2)
-                draw.line((x, y, x-10, y-10), fill='black', width=1)
-                draw.line((x, y, x+10, y-10), fill='black', width=1)
-
-        if 'fence' in prompt:
-            for x in range(0, WIDTH, 30):
-                draw.rectangle((x, HEIGHT-100, x+5, HEIGHT-50), fill='brown')
-                draw.rectangle((x, HEIGHT-90, x+30, HEIGHT-85), fill='brown')
-                draw.rectangle((x, HEIGHT-70, x+30, HEIGHT-65), fill='brown')
-                draw.rectangle((x, HEIGHT-50, x+30, HEIGHT-45), fill='brown')
-
-        if 'path' in prompt:
-            path_points = [(100, HEIGHT), (200, HEIGHT-50), (300, HEIGHT-100),
-                          (400, HEIGHT-50), (500, HEIGHT-100), (600, HEIGHT-50),
-                          (700, HEIGHT)]
-            for i in range(len(path_points)-1):
-                x1, y1 = path_points[i]
-                x2, y2 = path_points[i+1]
-                draw.line([(x1, y1), (x2, y2)], fill='sandybrown', width=40)
-                draw.line([(x1, y1-20), (x2, y2-20)], fill='saddlebrown', width=2)
-                draw.line([(x1, y1+20), (x2, y2+20)], fill='saddlebrown', width=2)
-
-        if 'bench' in prompt:
-            x, y = 300, 450
-            draw.rectangle((x, y, x+120, y+10), fill='brown')
-            draw.rectangle((x, y-40, x+120, y-35), fill='brown')
-            for leg_x in [x+20, x+100]:
-                draw.rectangle((leg_x, y+10, leg_x+10, y+40), fill='brown')
-
-        safe_prompt = re.sub(r'[^a-z0-9]', '_', prompt)[:30]
-        filename = f'{safe_prompt}.png'
-        filepath = os.path.join(IMAGE_FOLDER, filename)
+        img = (GROUND_BASE if hits & GROUND_KEYWORDS else SKY_BASE).copy()
+        draw = ImageDraw.Draw(img)
         
-        img.save(filepath)
-        return filename
+        for draw_element in plan_elements(hits):
+            draw_element(img, draw, rng)
+
+        save_image(img, filepath)
+        return True
         
     except Exception as e:
         print(f"Error generating image: {str(e)}")
-        return None
+        return False
+
+def image_id(prompt):
+    # The image filename without its extension. It depends only on the
+    # prompt, so every worker maps a prompt to the same file.
+    prompt = prompt.lower()
+    safe_prompt = UNSAFE_FILENAME_CHARS.sub('_', prompt)[:30]
+    # The readable prefix alone collides ('a cow' vs 'a cow!'), so add a
+    # digest of the whole prompt and the render version.
+    digest = hashlib.blake2b(f'{RENDER_VERSION}:{prompt}'.encode(), digest_size=8).hexdigest()
+    return f'{safe_prompt}_{digest}'
+
+def submit_image(prompt):
+    prompt = prompt.lower()
+    filename = image_id(prompt) + IMAGE_EXTENSION
+    filepath = IMAGE_PATH_PREFIX + filename
+    if os.path.exists(filepath):
+        future = Future()
+        future.set_result(filename)
+        return future
+
+    # Identical prompts arriving together share the first render
+    # instead of drawing the same file again.
+    with _inflight_lock:
+        future = _inflight.get(filename)
+        if future is None:
+            future = _inflight[filename] = RENDER_POOL.submit(
+                _render_inflight, prompt, filename, filepath)
+    return future
+
+def _render_inflight(prompt, filename, filepath):
+    try:
+        return filename if render_image(prompt, filepath) else None
+    finally:
+        with _inflight_lock:
+            del _inflight[filename]
+
+def generate_image(prompt):
+    return submit_image(prompt).result()
+
+@app.context_processor
+def template_settings():
+    return {'max_prompt_length': MAX_PROMPT_LENGTH}
+
+@app.errorhandler(413)
+def request_too_large(error):
+    # MAX_CONTENT_LENGTH rejects the body before the prompt is read.
+    if request.path.startswith('/api/'):
+        return jsonify(error=PROMPT_TOO_LONG), 413
+    return render_template('index.html', error=PROMPT_TOO_LONG), 413
 
 @app.route('/', methods=['GET'])
 def index():
@@ -254,20 +466,108 @@ def generate():
         prompt = request.form.get('prompt', '').strip()
         if not prompt:
             return render_template('index.html', error="Please enter a prompt")
+        if len(prompt) > MAX_PROMPT_LENGTH:
+            return render_template('index.html', error=PROMPT_TOO_LONG)
             
         filename = generate_image(prompt)
         if filename:
-            image_url = f'/{IMAGE_FOLDER}/{filename}'
+            image_url = IMAGE_URL_PREFIX + filename
             return render_template('index.html', prompt=prompt, image_url=image_url)
         else:
             return render_template('index.html', error="Failed to generate image")
             
+    except HTTPException:
+        raise
     except Exception as e:
         return render_template('index.html', error="An error occurred")
 
+def _finish_job(job_id, future):
+    # A finished render is visible to every worker as a file on disk; only
+    # failures need remembering, and only this worker knows about them.
+    if future.result() is None:
+        now = time.monotonic()
+        with _failed_renders_lock:
+            _expire_failed_renders(now)
+            _failed_renders[job_id] = now
+
+def _expire_failed_renders(now):
+    # _failed_renders is in insertion order, so the expired entries are
+    # all at the front.
+    while _failed_renders:
+        job_id = next(iter(_failed_renders))
+        if now - _failed_renders[job_id] < JOB_TTL:
+            break
+        del _failed_renders[job_id]
+
+def _wait_for_render(filename):
+    with _inflight_lock:
+        future = _inflight.get(filename)
+    if future is None:
+        # Rendering in another worker, or already finished: poll the disk.
+        time.sleep(PROGRESS_POLL_INTERVAL)
+    else:
+        wait([future], timeout=PROGRESS_POLL_INTERVAL)
+
+@app.route('/api/generate', methods=['POST'])
+def api_generate():
+    prompt = request.form.get('prompt', '').strip()
+    if not prompt:
+        return jsonify(error="Please enter a prompt"), 400
+    if len(prompt) > MAX_PROMPT_LENGTH:
+        return jsonify(error=PROMPT_TOO_LONG), 400
+
+    job_id = image_id(prompt)
+    with _failed_renders_lock:
+        _failed_renders.pop(job_id, None)
+    submit_image(prompt).add_done_callback(partial(_finish_job, job_id))
+    return jsonify(job_id=job_id), 202
+
+@app.route('/progress/<job_id>')
+def progress(job_id):
+    # The job id is the image filename, so any worker can answer this by
+    # watching the image folder, not just the one that took the POST.
+    if not JOB_ID_RE.fullmatch(job_id):
+        abort(404)
+    filename = job_id + IMAGE_EXTENSION
+    filepath = IMAGE_PATH_PREFIX + filename
+
+    def stream():
+        yield f"data: {json.dumps({'status': 'rendering'})}\n\n"
+        deadline = time.monotonic() + PROGRESS_TIMEOUT
+        while not os.path.exists(filepath):
+            if job_id in _failed_renders or time.monotonic() > deadline:
+                message = {'status': 'error', 'error': "Failed to generate image"}
+                yield f"data: {json.dumps(message)}\n\n"
+                return
+            _wait_for_render(filename)
+            # A comment line, so a client that went away is noticed early.
+            yield ": keepalive\n\n"
+        message = {'status': 'done', 'imageUrl': IMAGE_URL_PREFIX + filename}
+        yield f"data: {json.dumps(message)}\n\n"
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
 @app.route('/static/generated_images/<path:filename>')
 def static_files(filename):
-    return send_from_directory(IMAGE_FOLDER, filename)
+    if X_ACCEL_REDIRECT_PREFIX:
+        # Let nginx stream the file from its internal location.
+        if safe_join(IMAGE_FOLDER, filename) is None:
+            abort(404)
+        response = Response(mimetype=mimetypes.guess_type(filename)[0])
+        response.headers['X-Accel-Redirect'] = f'{X_ACCEL_REDIRECT_PREFIX}/{filename}'
+    else:
+        response = send_from_directory(IMAGE_FOLDER, filename, conditional=True)
+
+    # A generated file is never rewritten once it exists, and a drawing
+    # change bumps RENDER_VERSION and with it the filename.
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = IMAGE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # Development server only; set FLASK_DEBUG=1 for the debugger and
+    # reloader. Production runs under gunicorn (see gunicorn.conf.py).
+    app.run()
@@ -0,0 +1,13 @@
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', '5000')}")
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = 2
+
+# Each worker imports app.py itself, so the render bookkeeping
+# (_inflight, _failed_renders) is private to that worker. /progress reads
+# the image folder instead, so any worker can answer it. --preload would
+# share the import but forks after it, which buys nothing for this app.
+preload_app = False